@@ -1,13 +1,20 @@
 import random
 import math
+import heapq
+import os
 import time
+import multiprocessing
 from collections import deque
 
-#seed for RNG
-seed = time.time()
-random.seed(seed)
-print("Using seed %d"%(seed))
 debug = False
+_log = math.log
+#con hasta esta cantidad de eventos recorrer la lista es mas barato que mantener un heap
+MAX_EVENTOS_SCAN = 8
+#tiempo de fin de cada replica
+TIEMPO_SIMULACION = 8
+#con menos replicas (o un solo core) se corre en serie, sin levantar el Pool.
+#200 es una estimacion, no esta medido en una maquina con varios cores
+MIN_REPLICAS_PARALELO = 200
 
 class Event:
     """
@@ -17,19 +24,30 @@ class Event:
             rate: the event rate ex: 1/5->1 event per 5 time unit
             handler: the function handler for that event.
     """
+    __slots__ = ('name','rate','handler','nextOcurrenceTime','disabled','mmi','_encolado')
     def __init__(self,name,rate,handler):
         self.name = name
         self.rate = rate
         self.handler = handler
         self.nextOcurrenceTime = 0
         self.disabled = False
+        self.mmi = None #simulador dueño del evento, se asigna en registerEvent
+        self._encolado = False #True mientras el evento esta en el heap del simulador
+    def _call(self,mmi):
+        """
+        Dispatch the event, subclasses replace it with a pre-bound handler
+        """
+        self.handler(self,mmi)
+    def __lt__(self,other):
+        """
+        Order events by ocurrence time, breaks ties between heap entries with equal time
+        """
+        return self.nextOcurrenceTime < other.nextOcurrenceTime
     def disable(self):
         """
-        Disable event ocurrence
+        Disable event ocurrence, if queued it is discarded when popped
         """
         self.disabled = True
-    def callHandler(self,param):
-        self.handler(self,param)
     def enable(self):
         self.disabled = False
     def reset(self):
@@ -41,21 +59,26 @@ class Event:
     def getNextOcurrenceTime(self,clock):
         """
         Calculates event ocurrence based on exponential distribution formula and rate
+        The event must be registered in an MMI, its RNG is used for the draw
             Params
                 clock: simulation clock time
         """
         self.enable()
-        self.nextOcurrenceTime = (-self.rate * math.log(random.random())) + clock
+        mmi = self.mmi
+        #1.0 - random() esta en (0,1], igual que random.expovariate, evita log(0)
+        self.nextOcurrenceTime = clock - self.rate * _log(1.0 - mmi.rng.random())
+        if(mmi._usarHeap): #con pocos eventos getNextEvent recorre la lista, no hace falta el heap
+            mmi._schedule(self)
         return self.nextOcurrenceTime
 
 class Arribo(Event):
     """
     Custom event type Arribo
     """
+    __slots__ = ('_call',)
     def __init__(self,name,rate,handler):
         Event.__init__(self,name,rate,handler)
-    def callHandler(self,param):
-        self.handler(param)
+        self._call = handler
 
 class Partida(Event):
     """
@@ -64,11 +87,11 @@ class Partida(Event):
             (name,rate,handler) Event params
             serverID: The server id that will handle this event
     """
+    __slots__ = ('serverID','_call')
     def __init__(self,name,rate,handler,serverID):
         Event.__init__(self,name,rate,handler)
         self.serverID = serverID
-    def callHandler(self,param):
-        self.handler(param,self.serverID)
+        self._call = lambda mmi, h=handler, sid=serverID: h(mmi,sid)
 
 
 
@@ -81,34 +104,48 @@ class Server:
         ts: acumulado tiempo de servicio
         bt: acumulado utilizacion del servidor
     """
+    __slots__ = ('qt','cccd','sd','ts','bt','cola','servidorOcupado','tServidorOcupado')
     def __init__(self):
+        self.cola = deque()
+        self.reset()
+    def reset(self):
+        """
+        Resets counters and empties the queue, so the server can be reused between replicas
+        """
         self.qt = 0
         self.cccd = 0
         self.sd = 0
         self.ts = 0
         self.bt = 0
-        self.cola = []
+        self.cola.clear()
         self.servidorOcupado = False
-        self.longCola = 0
         self.tServidorOcupado = 0
     def __str__(self):
         return "{qt:%f, cccd:%d, sd:%f , ts: %f , bt: %f}"%(self.qt,self.cccd,self.sd,self.ts,self.bt)
 
         
 class MMI:
-    def __init__(self,nServidores):
+    def __init__(self,nServidores,seed=None):
+        self.rng = random.Random(seed) #RNG propio, cada replica es independiente
         self._events = {}
+        self._partidas = {} #serverID -> evento Partida de ese servidor
         self.nServidores = nServidores
+        self._servers = [Server() for _ in range(nServidores)]
+        self._pq = [] #heap de (nextOcurrenceTime, evento)
+        self._usarHeap = True
     def initialization(self,eventos):
-        self._servers = []
-        for _ in range(self.nServidores):
-            self._servers.append(Server())
+        #reusamos los servidores, solo se resetean sus contadores
+        for server in self._servers:
+            server.reset()
         self.reloj = 0
         self.relojA = self.reloj #estado anterior del reloj
+        self._pq = []
+        self._usarHeap = len(self._events) > MAX_EVENTOS_SCAN
         #reseteamos los eventos a su estado inicial (nextOcurrenceTime = 0, disabled = True)
         for eventName in self._events:
             event = self._events[eventName]
             event.reset()
+            event._encolado = False
         #Eventos que deben inicializarse su proximaOcurrencia - en este caso arribo, pero
         #el codigo permite manejar varios eventos que pongamos como iniciales
         for e in eventos:
@@ -120,51 +157,99 @@ class MMI:
                 Event: a custom Event defined above [ex: Arribo].
         """
         self._events[event.name] = event
+        event.mmi = self
+        if(isinstance(event,Partida)):
+            self._partidas[event.serverID] = event
         return event
+    def reseed(self,seed):
+        """
+        Reseeds the simulator RNG, so a replica only depends on seed
+        """
+        self.rng.seed(seed)
     def generateNextEvent(self,name):
         return (self._events[name]).getNextOcurrenceTime(self.reloj) 
+    def partidaForServer(self,sid):
+        """
+        Returns the Partida event registered for server sid
+        """
+        return self._partidas[sid]
+    def _schedule(self,event):
+        """
+        Push event into the heap with its current ocurrence time
+        """
+        #un evento solo se reprograma despues de salir del heap (o en initialization),
+        #si estuviera encolado cambiar su tiempo romperia el orden del heap
+        assert not event._encolado, "evento %s reprogramado estando en el heap"%(event.name)
+        event._encolado = True
+        heapq.heappush(self._pq,(event.nextOcurrenceTime,event))
     def getNextEvent(self):
         """
-        Returns event with less ocurrence time from events list
+        Returns event with less ocurrence time, popping it from the heap
+        or scanning the events list when there are few events
         """
-        minE = 999999
-        nextEvent = None
-        for eventName in self._events:
-            event = self._events[eventName]
-            if ( event.disabled ):
-                continue
-            if ( event.nextOcurrenceTime < minE ):
-                minE = event.nextOcurrenceTime
-                nextEvent = event
-        return nextEvent
+        if(not self._usarHeap):
+            minE = float("inf")
+            nextEvent = None
+            for event in self._events.values():
+                if(not event.disabled and event.nextOcurrenceTime < minE):
+                    minE = event.nextOcurrenceTime
+                    nextEvent = event
+            return nextEvent
+        while self._pq:
+            (t,event) = heapq.heappop(self._pq)
+            event._encolado = False
+            if(event.disabled):
+                continue #se deshabilito mientras estaba en el heap
+            return event
+        return None
     def relojNextEvent(self):
         """
         Forward clock time to next event time, and call event handler function
         """
         proximoEvento = self.getNextEvent()
         self.relojA = self.reloj
-        self.reloj += proximoEvento.nextOcurrenceTime - self.relojA
-        proximoEvento.callHandler(self)
+        self.reloj = proximoEvento.nextOcurrenceTime
+        proximoEvento._call(self)
+    def run(self,tiempoFin):
+        """
+        Run the simulation until clock reaches tiempoFin
+            Params
+                tiempoFin: simulation end time
+        """
+        relojNextEvent = self.relojNextEvent
+        while(self.reloj < tiempoFin):
+            relojNextEvent()
     def findFreeServer(self):
         """
         Return random free server or the one with less queue
         """
+        servers = self._servers
+        libres = 0 #cantidad de servidores libres
+        libre = 0
         _min = 9999999
-        server = None
         sid = 0
-        frees = []
         for s in range(self.nServidores):
-            current = self._servers[s]
+            current = servers[s]
             if(not current.servidorOcupado):
-                frees.append((current,s))
-            if(current.longCola < _min):
-                _min = current.longCola
-                server = current
-                sid = s
-        if(len(frees) == 0):
-            return (server,sid)
-        else:#pick random free server, this prevents always chosing server 0
-            return random.choice(frees)
+                libres += 1
+                libre = s
+            elif(libres == 0):
+                #la cola mas corta solo importa si no hay ninguno libre
+                longCola = len(current.cola)
+                if(longCola < _min):
+                    _min = longCola
+                    sid = s
+        if(libres == 0):
+            return (servers[sid],sid)
+        if(libres > 1):#pick random free server, this prevents always chosing server 0
+            k = self.rng.randrange(libres)
+            for s in range(self.nServidores):
+                if(not servers[s].servidorOcupado):
+                    if(k == 0):
+                        libre = s
+                        break
+                    k -= 1
+        return (servers[libre],libre)
     def getServerById(self,sid):
         return self._servers[sid]
     def reporte(self):
@@ -172,14 +257,16 @@ class MMI:
         Return array of tuples of all servers statical counters
         """
         ret = []
-        for i in range(self.nServidores):
-            server = self._servers[i]
-            demoraPromedio =  (server.sd/float(server.cccd)) * 60 if server.cccd != 0 else 0
-            numeroPromedioClientesCola = server.qt/float(self.reloj)
+        reloj = self.reloj
+        invReloj = 1.0/reloj
+        for server in self._servers:
+            invCccd = (1.0/server.cccd) if server.cccd != 0 else 0.0
+            demoraPromedio = server.sd * invCccd * 60.0
+            numeroPromedioClientesCola = server.qt * invReloj
             if(server.servidorOcupado):
-                server.bt += (self.reloj - server.tServidorOcupado)
-            utilizacionServidor = (server.bt/float(self.reloj))*100
-            tiempoServicioPromedio =  ((server.ts/float(server.cccd))*60) if (server.cccd != 0) else 0
+                server.bt += (reloj - server.tServidorOcupado)
+            utilizacionServidor = server.bt * invReloj * 100.0
+            tiempoServicioPromedio = server.ts * invCccd * 60.0
             if(debug):
                 print("\tDemoraPromedio: %fmin\n\
             NumeroPromedioClientesCola: %f clientes\n\
@@ -196,78 +283,115 @@ def farribo(self):
     Function handler for Custom Event Arrribo
     """
     (server,sid) = self.findFreeServer()
+    reloj = self.reloj
     self.generateNextEvent("arribo")
     if(server.servidorOcupado == False):
         server.servidorOcupado = True
-        server.tServidorOcupado = self.reloj
+        server.tServidorOcupado = reloj
         #actualizar estadisticos
         server.cccd += 1
-        server.ts += (self.generateNextEvent("partida%d"%(sid)) - self.reloj) 
+        server.ts += (self.partidaForServer(sid).getNextOcurrenceTime(reloj) - reloj) 
         #partida del cliente que arribo a la cola vacia
     else:
-        colaLen = server.longCola
-        server.qt += (self.reloj - self.relojA) * colaLen
-        server.cola.append(self.reloj)
-        server.longCola += 1
+        cola = server.cola
+        server.qt += (reloj - self.relojA) * len(cola)
+        cola.append(reloj)
 
 #funcion manejadora del evento partida
 def fpartida(self,serverID):
     """
     Function handler for Custom Event Partida
     """
-    server = self.getServerById(serverID)
-    if(server.longCola == 0):
+    server = self._servers[serverID]
+    cola = server.cola
+    reloj = self.reloj
+    if(not cola):
             #si no hay clientes no puede existir una partida como proximo evento
-        (self._events["partida%d"%(serverID)]).disable() 
+        self.partidaForServer(serverID).disable()
         server.servidorOcupado = False
-        server.bt += (self.reloj - server.tServidorOcupado)
+        server.bt += (reloj - server.tServidorOcupado)
     else:
         #calculamos la partida del cliente que sale de la cola
-        server.ts += (self.generateNextEvent("partida%d"%(serverID)) - self.reloj) 
-        colaLen = server.longCola
-        server.qt += (self.reloj - self.relojA) * colaLen
-        t = server.cola.pop(0) #tiempo de llegada a la cola del cliente que parte
-        server.longCola -= 1
-        server.sd += (self.reloj - t)
+        server.ts += (self.partidaForServer(serverID).getNextOcurrenceTime(reloj) - reloj)
+        server.qt += (reloj - self.relojA) * len(cola)
+        t = cola.popleft() #tiempo de llegada a la cola del cliente que parte
+        server.sd += (reloj - t)
         server.cccd += 1
 
 
-#-------main program------------#
-nServidores = int(input("Ingrese número de servidores: "))
-mmi = MMI(nServidores)
-ta = int(input("Ingrese tasa de arribo: "))
-ts = int(input("Ingrese tasa de servicio: "))
+def buildMMI(nServidores,tasaArribo,tasaServicio):
+    """
+    Create a simulator with its Arribo and Partida events registered
+        Returns (mmi,arribo)
+    """
+    mmi = MMI(nServidores)
+    arribo = mmi.registerEvent(Arribo("arribo",tasaArribo,farribo))
+    for i in range(nServidores):
+        mmi.registerEvent(Partida("partida%d"%(i),tasaServicio,fpartida,i))
+    return (mmi,arribo)
 
-tasaArribo = 1/float(ta)
-tasaServicio = 1/float(ts)
+#simulador de cada proceso worker, se crea una sola vez en initWorker
+_worker = None
 
-arribo = mmi.registerEvent(Arribo("arribo",tasaArribo,farribo))
-sumatoriaReplicas = []
-for i in range(nServidores):
-    mmi.registerEvent(Partida("partida%d"%(i),tasaServicio,fpartida,i))
-    sumatoriaReplicas.append((0,0,0,0))
+def initWorker(nServidores,tasaArribo,tasaServicio):
+    """
+    Pool initializer, builds the simulator reused by every replica run in this process
+    """
+    global _worker
+    _worker = buildMMI(nServidores,tasaArribo,tasaServicio)
 
-numeroReplicas = int(input("Ingrese numero de replicas: "))
-for i in range(0,numeroReplicas):
+def run_one(seed):
+    """
+    Run a single replica on this worker simulator and return its report
+        Params
+            seed: RNG seed for the replica
+    """
+    (mmi,arribo) = _worker
+    mmi.reseed(seed)
     mmi.initialization([arribo])
-    while(mmi.reloj < 8):
-        mmi.relojNextEvent()
-    report = mmi.reporte()
-    for j in range(len(report)):
-        reportTuple = report[j]
-        sumatoriaReplicas[j] = tuple(map(sum,zip(sumatoriaReplicas[j],reportTuple)))
+    mmi.run(TIEMPO_SIMULACION)
+    return mmi.reporte()
+
+
+#-------main program------------#
+if __name__ == "__main__":
+    #seed for RNG, las semillas de cada replica se derivan de esta
+    seed = time.time_ns()
+    print("Using seed %d"%(seed))
+    nServidores = int(input("Ingrese número de servidores: "))
+    ta = int(input("Ingrese tasa de arribo: "))
+    ts = int(input("Ingrese tasa de servicio: "))
+
+    tasaArribo = 1/float(ta)
+    tasaServicio = 1/float(ts)
+
+    #acumulador de estadisticos por servidor, se suma en el lugar
+    sumatoria = [[0.0,0.0,0.0,0.0] for _ in range(nServidores)]
+
+    numeroReplicas = int(input("Ingrese numero de replicas: "))
+    #semillas de 64 bits sacadas de un RNG propio, dos corridas no comparten replicas
+    generador = random.Random(seed)
+    semillas = [generador.getrandbits(64) for _ in range(numeroReplicas)]
+    if((os.cpu_count() or 1) > 1 and numeroReplicas >= MIN_REPLICAS_PARALELO):
+        #las replicas son independientes, se reparten entre los cores disponibles
+        with multiprocessing.Pool(initializer=initWorker,initargs=(nServidores,tasaArribo,tasaServicio)) as pool:
+            reportes = pool.map(run_one,semillas)
+    else:
+        initWorker(nServidores,tasaArribo,tasaServicio)
+        reportes = [run_one(s) for s in semillas]
+    for report in reportes:
+        for (acum,reportTuple) in zip(sumatoria,report):
+            for k in range(4):
+                acum[k] += reportTuple[k]
 
-#divido la sumatoria por el numero de replicas
-resultado = []
-for t in range(len(sumatoriaReplicas)):
-    prom = sumatoriaReplicas[t]
-    resultado.append(tuple([x/float(numeroReplicas) for x in prom]))
+    #divido la sumatoria por el numero de replicas
+    resultado = [tuple([x/float(numeroReplicas) for x in acum]) for acum in sumatoria]
 
-#para cada servidor muestro los estadisticos recolectados
-for i in range(len(resultado)):
-    print("Servidor %d"%(i))
-    print("\tDemoraPromedio: %f min\n\
+    #para cada servidor muestro los estadisticos recolectados
+    for i in range(len(resultado)):
+        print("Servidor %d"%(i))
+        print("\tDemoraPromedio: %f min\n\
         NumeroPromedioClientesCola: %f clientes\n\
         UtilizacionServidor: %f%%\r\n\
         TiempoServicioPromedio: %f min" \
-        %resultado[i])
+            %resultado[i])